@@ -5,7 +5,9 @@ import sys
 import re
 import logging
 import glob
+import hashlib
 import rich.console
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from yaml import YAMLError
 
@@ -21,6 +23,10 @@ stderr = rich.console.Console(
     highlight=False,
     force_terminal=relecov_tools.utils.rich_force_colors(),
 )
+# Number of threads used for reading the per sample files
+MAX_IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Size in bytes of the buffer used when reading the per sample files
+BUFFER_SIZE = 1 << 20
 
 
 class BioinfoMetadata:
@@ -58,21 +64,108 @@ class BioinfoMetadata:
         required_files = self.configuration.get_topic_data(
             "bioinfo_analysis", "required_file"
         )
-        self.req_files = {}
-        for key, file in required_files.items():
-            f_path = os.path.join(self.input_folder, file)
-            if not os.path.isfile(f_path):
-                log.error("File %s does not exist", file)
-                stderr.print(f"[red]File {file} does not exist")
-                sys.exit(1)
-            self.req_files[key] = f_path
+        # list the input folder once instead of checking each file on disk
+        try:
+            with os.scandir(self.input_folder) as entries:
+                folder_files = {entry.name for entry in entries if entry.is_file()}
+            missing = [
+                file for file in required_files.values() if file not in folder_files
+            ]
+        except OSError:
+            # folder can not be listed, files may still be reachable
+            missing = [
+                file
+                for file in required_files.values()
+                if not os.path.isfile(os.path.join(self.input_folder, file))
+            ]
+        if missing:
+            log.error("Files %s do not exist", missing)
+            stderr.print(f"[red]Files {missing} do not exist")
+            sys.exit(1)
+        self.req_files = {
+            key: os.path.join(self.input_folder, file)
+            for key, file in required_files.items()
+        }
+        # Fetch once the configuration used when adding the bioinfo fields
+        self._fixed_values = self.configuration.get_topic_data(
+            "bioinfo_analysis", "fixed_values"
+        )
+        self._mapping_stats_fields = list(
+            self.configuration.get_topic_data(
+                "bioinfo_analysis", "mapping_stats"
+            ).items()
+        )
+        self._pangolin_fields = list(
+            self.configuration.get_topic_data(
+                "bioinfo_analysis", "mapping_pangolin"
+            ).items()
+        )
+        self._consensus_fields = self.configuration.get_topic_data(
+            "bioinfo_analysis", "mapping_consensus"
+        )
+        # values set when the pangolin or consensus file of a sample is missing
+        self._pangolin_empty = dict.fromkeys(
+            [field for field, _ in self._pangolin_fields], ""
+        )
+        self._consensus_empty = dict.fromkeys(self._consensus_fields, "")
+        self._variant_metrics_fields = list(
+            self.configuration.get_topic_data(
+                "bioinfo_analysis", "mapping_variant_metrics"
+            ).items()
+        )
+        self._version_fields = list(
+            self.configuration.get_topic_data(
+                "bioinfo_analysis", "mapping_version"
+            ).items()
+        )
 
-    def add_fixed_values(self, j_data):
-        """include the fixed data defined in configuration"""
-        f_values = self.configuration.get_topic_data("bioinfo_analysis", "fixed_values")
+    def add_common_values(self, j_data):
+        """Include the values that are the same for all samples: the fixed
+        data defined in configuration, the software versions and the variant
+        long table path. They are merged and added to each row at once
+        """
+        common_values = dict(self._fixed_values)
+        common_values.update(self.get_software_versions())
+        common_values["long_table_path"] = self.get_long_table_path()
         for row in j_data:
-            for field, value in f_values.items():
-                row[field] = value
+            row.update(common_values)
+        return j_data
+
+    def _add_table_values(
+        self, j_data, f_path, sep, key_position, mapping_fields, table_name
+    ):
+        """Add to each row the mapped fields of its sample in the table file.
+        All the fields or samples that are not found are reported before exiting
+        """
+        map_data = relecov_tools.utils.read_csv_file_return_dict(
+            f_path, sep, key_position
+        )
+        bio_fields = [field for field, _ in mapping_fields]
+        src_keys = [value for _, value in mapping_fields]
+        if map_data:
+            table_fields = next(iter(map_data.values()))
+            missing = [key for key in src_keys if key not in table_fields]
+            if missing:
+                log.error("Fields %s not found in %s", missing, table_name)
+                stderr.print(f"[red]Fields {missing} not found in {table_name}")
+                sys.exit(1)
+        # Keep for each sample only a tuple with the mapped values, in order
+        projected = {
+            sample: tuple(values[key] for key in src_keys)
+            for sample, values in map_data.items()
+        }
+        missing = []
+        for row in j_data:
+            sample = row["sequencing_sample_id"]
+            sample_values = projected.get(sample)
+            if sample_values is None:
+                missing.append(sample)
+            else:
+                row.update(zip(bio_fields, sample_values))
+        if missing:
+            log.error("Samples %s not found in %s", missing, table_name)
+            stderr.print(f"[red]Samples {missing} not found in {table_name}")
+            sys.exit(1)
         return j_data
 
     def include_data_from_mapping_stats(self, j_data):
@@ -84,156 +177,184 @@ class BioinfoMetadata:
         """
         # position of the sample columns inside mapping file
         sample_position = 4
-        map_data = relecov_tools.utils.read_csv_file_return_dict(
-            self.req_files["mapping_stats"], "\t", sample_position
-        )
-
-        mapping_fields = self.configuration.get_topic_data(
-            "bioinfo_analysis", "mapping_stats"
+        return self._add_table_values(
+            j_data,
+            self.req_files["mapping_stats"],
+            "\t",
+            sample_position,
+            self._mapping_stats_fields,
+            "mapping stats",
         )
 
-        for row in j_data:
-            for field, value in mapping_fields.items():
-                try:
-                    row[field] = map_data[row["sequencing_sample_id"]][value]
-                except KeyError as e:
-                    log.error("Field %s not found in mapping stats", e)
-                    stderr.print(f"[red]Field {e} not found in mapping stats")
-                    sys.exit(1)
-        return j_data
-
     def include_pangolin_data(self, j_data):
         """Include pangolin data collecting form each file generated by pangolin"""
-        mapping_fields = self.configuration.get_topic_data(
-            "bioinfo_analysis", "mapping_pangolin"
-        )
-        for row in j_data:
-            if "-" in row["sequencing_sample_id"]:
-                sample_name = row["sequencing_sample_id"].replace("-", "_")
-            else:
-                sample_name = row["sequencing_sample_id"]
-
-            f_name_regex = sample_name + ".pangolin.*.csv"
-            f_path = os.path.join(self.input_folder, f_name_regex)
-            pangolin_sample_file = glob.glob(f_path)
-            if pangolin_sample_file:
-                if len(pangolin_sample_file) == 1:
-                    try:
-                        result_regex = re.search(
-                            "(.*)\.pangolin\.(.*)\.csv", pangolin_sample_file[0]
-                        )
-                        row["lineage_analysis_date"] = result_regex.group(2)
-                        row["lineage_analysis_date"] = datetime.strptime(
-                            row["lineage_analysis_date"], "%Y%m%d"
-                        ).strftime("%Y-%m-%d")
-                    except Exception as e:
+        sample_names = [row["sequencing_sample_id"].replace("-", "_") for row in j_data]
+        f_paths = [
+            os.path.join(self.input_folder, f"{sample_name}.pangolin.*.csv")
+            for sample_name in sample_names
+        ]
+        # Files are searched and read in parallel, rows are filled afterwards
+        with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as executor:
+            pangolin_files = list(executor.map(glob.glob, f_paths))
+            futures = [
+                (
+                    executor.submit(
+                        relecov_tools.utils.read_csv_file_return_dict, p_files[0], ","
+                    )
+                    if len(p_files) == 1
+                    else None
+                )
+                for p_files in pangolin_files
+            ]
+            for row, sample_name, pangolin_sample_file, future in zip(
+                j_data, sample_names, pangolin_files, futures
+            ):
+                if pangolin_sample_file:
+                    if len(pangolin_sample_file) == 1:
+                        try:
+                            result_regex = re.search(
+                                "(.*)\.pangolin\.(.*)\.csv", pangolin_sample_file[0]
+                            )
+                            row["lineage_analysis_date"] = result_regex.group(2)
+                            row["lineage_analysis_date"] = datetime.strptime(
+                                row["lineage_analysis_date"], "%Y%m%d"
+                            ).strftime("%Y-%m-%d")
+                        except Exception as e:
+                            stderr.print(
+                                f"[red] Pattern not found in file name. Error: {e}"
+                            )
+                        try:
+                            f_data = future.result()
+                        except FileNotFoundError as e:
+                            log.error("File %s not found ", e)
+                            stderr.print(f"[red]File {e} not found")
+                            # When file does not exist set all values to empty
+                            row.update(self._pangolin_empty)
+                            continue
+                            # sys.exit(1)
+                        first_record = next(iter(f_data.values()))
+                        for field, value in self._pangolin_fields:
+                            row[field] = first_record[value]
+                    else:
+                        # We need to handle this when more than one analysis in the folder. How can we do this? Use the last one?
                         stderr.print(
-                            f"[red] Pattern not found in file name. Error: {e}"
-                        )
-                    try:
-                        f_data = relecov_tools.utils.read_csv_file_return_dict(
-                            result_regex.group(), ","
+                            "[red] More than one pangolin file found for the same sample "
                         )
-                    except FileNotFoundError as e:
-                        log.error("File %s not found ", e)
-                        stderr.print(f"[red]File {e} not found")
-                        # When file does not exist set all values to empty
-                        for field, value in mapping_fields.items():
-                            row[field] = ""
-                        continue
-                        # sys.exit(1)
-                    pang_key = list(f_data.keys())[0]
-                    for field, value in mapping_fields.items():
-                        row[field] = f_data[pang_key][value]
+                        sys.exit(1)
                 else:
-                    # We need to handle this when more than one analysis in the folder. How can we do this? Use the last one?
-                    stderr.print(
-                        "[red] More than one pangolin file found for the same sample "
-                    )
-                    sys.exit(1)
-            else:
-                stderr.print(f"[yellow] No pangolin file for sample: {sample_name}")
+                    stderr.print(f"[yellow] No pangolin file for sample: {sample_name}")
 
         return j_data
 
+    def _read_consensus_meta(self, f_path):
+        """Read the consensus fasta file once, in chunks, to get the md5 of
+        the file together with the description of its record and the sequence
+        length. Whitespaces inside the sequence are not counted. As SeqIO.read
+        does, ValueError is raised when the file is empty, does not start with
+        a fasta header or has more than one record
+        """
+        md5 = hashlib.md5()
+        header = b""
+        header_done = False
+        line_start = True
+        genome_length = 0
+        with open(f_path, "rb", buffering=BUFFER_SIZE) as fh:
+            for chunk in iter(lambda: fh.read(BUFFER_SIZE), b""):
+                md5.update(chunk)
+                if not header_done:
+                    if not header and not chunk.startswith(b">"):
+                        raise ValueError(f"{f_path} does not start with a fasta header")
+                    # as SeqIO does, a single \r is also a line break
+                    header_end = re.search(b"[\r\n]", chunk)
+                    if header_end is None:
+                        header += chunk
+                        continue
+                    header += chunk[: header_end.start()]
+                    chunk = chunk[header_end.start() + 1 :]
+                    header_done = True
+                if (
+                    (line_start and chunk.startswith(b">"))
+                    or b"\n>" in chunk
+                    or b"\r>" in chunk
+                ):
+                    raise ValueError(f"More than one record found in {f_path}")
+                genome_length += len(chunk.translate(None, b" \t\r\n"))
+                if chunk:
+                    line_start = chunk.endswith((b"\n", b"\r"))
+        if not header:
+            raise ValueError(f"No records found in {f_path}")
+        description = header[1:].decode().rstrip()
+        return description, genome_length, md5.hexdigest()
+
     def include_consensus_data(self, j_data):
         """Include genome length, name, file name, path and md5 by preprocessing
         each file of consensus.fa
         """
-
-        mapping_fields = self.configuration.get_topic_data(
-            "bioinfo_analysis", "mapping_consensus"
-        )
-        for row in j_data:
-            if "-" in row["sequencing_sample_id"]:
-                sample_name = row["sequencing_sample_id"].replace("-", "_")
-            else:
-                sample_name = row["sequencing_sample_id"]
-            f_name = sample_name + ".consensus.fa"
-            f_path = os.path.join(self.input_folder, f_name)
-            try:
-                record_fasta = relecov_tools.utils.read_fasta_return_SeqIO_instance(
-                    f_path
+        sample_ids = [row["sequencing_sample_id"] for row in j_data]
+        f_names = [
+            f"{sample_id.replace('-', '_')}.consensus.fa" for sample_id in sample_ids
+        ]
+        # Files are read in parallel, rows are filled afterwards
+        with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as executor:
+            futures = [
+                executor.submit(
+                    self._read_consensus_meta, os.path.join(self.input_folder, f_name)
                 )
-            except FileNotFoundError as e:
-                log.error("File %s not found ", e)
-                stderr.print(f"[red]File {e} not found")
-                for item in mapping_fields:
-                    row[item] = ""
-                continue
-            row["consensus_genome_length"] = str(len(record_fasta))
-            row["consensus_sequence_name"] = record_fasta.description
-            row["consensus_sequence_filepath"] = self.input_folder
-            row["consensus_sequence_filename"] = f_name
-            row["consensus_sequence_md5"] = relecov_tools.utils.calculate_md5(f_path)
-            base_calculation = int(row["read_length"]) * len(record_fasta)
-            if row["sequencing_sample_id"] != "":
-                row["number_of_base_pairs_sequenced"] = str(base_calculation * 2)
-            else:
-                row["number_of_base_pairs_sequenced"] = str(base_calculation)
+                for f_name in f_names
+            ]
+            for row, sample_id, f_name, future in zip(
+                j_data, sample_ids, f_names, futures
+            ):
+                try:
+                    description, genome_length, md5_value = future.result()
+                except FileNotFoundError as e:
+                    log.error("File %s not found ", e)
+                    stderr.print(f"[red]File {e} not found")
+                    row.update(self._consensus_empty)
+                    continue
+                row["consensus_genome_length"] = str(genome_length)
+                row["consensus_sequence_name"] = description
+                row["consensus_sequence_filepath"] = self.input_folder
+                row["consensus_sequence_filename"] = f_name
+                row["consensus_sequence_md5"] = md5_value
+                base_calculation = int(row["read_length"]) * genome_length
+                if sample_id != "":
+                    row["number_of_base_pairs_sequenced"] = str(base_calculation * 2)
+                else:
+                    row["number_of_base_pairs_sequenced"] = str(base_calculation)
 
         return j_data
 
-    def include_long_table_path(self, j_data):
-        """Include the variant long table path by searchin the in input folder
+    def get_long_table_path(self):
+        """Get the variant long table path by searching in the input folder
         the file name that contains long_table.csv
         """
-        condition = os.path.join(self.input_folder, "*long_table.csv")
-        f_path = relecov_tools.utils.get_files_match_condition(condition)
-        if len(f_path) == 0:
-            long_table_path = ""
-        else:
-            long_table_path = f_path[0]
-        for row in j_data:
-            row["long_table_path"] = long_table_path
-        return j_data
+        long_table_path = ""
+        with os.scandir(self.input_folder) as entries:
+            for entry in entries:
+                # skip hidden files
+                if entry.name.startswith("."):
+                    continue
+                if entry.name.endswith("long_table.csv"):
+                    long_table_path = entry.path
+                    break
+        return long_table_path
 
     def include_variant_metrics(self, j_data):
         """Include the # Ns per 100kb consensus from the summary variant
         metric file_exists
         """
-        map_data = relecov_tools.utils.read_csv_file_return_dict(
-            self.req_files["variants_metrics"], ","
-        )
-        mapping_fields = self.configuration.get_topic_data(
-            "bioinfo_analysis", "mapping_variant_metrics"
-        )
-        for row in j_data:
-            for field, value in mapping_fields.items():
-                try:
-                    row[field] = map_data[row["sequencing_sample_id"]][value]
-                except KeyError as e:
-                    log.error("Field %s not found in mapping stats", e)
-                    stderr.print(f"[red]Field {e} not found in mapping stats")
-                    sys.exit(1)
-        return j_data
-
-    def include_software_versions(self, j_data):
-        """Include versions from the yaml version file"""
-        version_fields = self.configuration.get_topic_data(
-            "bioinfo_analysis", "mapping_version"
+        return self._add_table_values(
+            j_data,
+            self.req_files["variants_metrics"],
+            ",",
+            None,
+            self._variant_metrics_fields,
+            "variant metrics",
         )
 
+    def get_software_versions(self):
+        """Get the versions from the yaml version file for each field"""
         try:
             versions = relecov_tools.utils.read_yml_file(self.req_files["versions"])
         except YAMLError as e:
@@ -241,13 +362,11 @@ class BioinfoMetadata:
             stderr.print("[red]Unable to process version file")
             stderr.print(f" {e}")
             sys.exit(1)
-        for row in j_data:
-            for field, version_data in version_fields.items():
-
-                for key, value in version_data.items():
-
-                    row[field] = versions[key][value]
-        return j_data
+        resolved = {}
+        for field, version_data in self._version_fields:
+            for key, value in version_data.items():
+                resolved[field] = versions[key][value]
+        return resolved
 
     def collect_info_from_lab_json(self):
         """Create the list of dictionaries from the data that is on json lab
@@ -259,15 +378,9 @@ class BioinfoMetadata:
             log.error("%s invalid json file", self.json_file)
             stderr.print(f"[red] {self.json_file} invalid json file")
             sys.exit(1)
-        #        j_data = []
-        #        mapping_fields = self.configuration.get_topic_data(
-        #            "bioinfo_analysis", "required_fields_from_lab_json"
-        #        )
-        #        for row in json_lab_data:
-        #            j_data_dict = {}
-        #            for lab_field, bio_field in mapping_fields.items():
-        #                j_data_dict[bio_field] = row[lab_field]
-        #            j_data.append(j_data_dict)
+        # Lab rows are returned as they are. Projecting them with
+        # required_fields_from_lab_json would drop lab fields, as read_length,
+        # that are needed later when including the consensus data
         return json_lab_data
 
     def create_bioinfo_file(self):
@@ -277,20 +390,16 @@ class BioinfoMetadata:
         """
         stderr.print("[blue]Reading lab metadata json")
         j_data = self.collect_info_from_lab_json()
-        stderr.print("[blue]Adding fixed values")
-        j_data = self.add_fixed_values(j_data)
+        stderr.print("[blue]Adding fixed values, software versions and long table path")
+        j_data = self.add_common_values(j_data)
         stderr.print("[blue]Adding data from mapping stats")
         j_data = self.include_data_from_mapping_stats(j_data)
-        stderr.print("[blue]Adding software versions")
-        j_data = self.include_software_versions(j_data)
         stderr.print("[blue]Adding summary variant metrics")
         j_data = self.include_variant_metrics(j_data)
         stderr.print("[blue]Adding pangolin information")
         j_data = self.include_pangolin_data(j_data)
         stderr.print("[blue]Adding consensus data")
         j_data = self.include_consensus_data(j_data)
-        stderr.print("[blue]Adding variant long table path")
-        j_data = self.include_long_table_path(j_data)
         file_name = (
             "bioinfo_" + os.path.splitext(os.path.basename(self.json_file))[0] + ".json"
         )
@@ -4,6 +4,7 @@ Common utility function used for relecov_tools package.
 """
 import os
 import glob
+import re
 import hashlib
 import logging
 import questionary
@@ -14,6 +15,11 @@ from itertools import islice
 from Bio import SeqIO
 from rich.console import Console
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
 
@@ -174,8 +180,53 @@ def save_local_md5(file_name, md5_value):
     return True
 
 
+def same_json_with_orjson(data):
+    """Check that data only contains values that orjson writes in the same
+    way as the json module: dicts with str keys, lists, str, bool, None and
+    integers in 64 bits. Floats are not accepted because their format differs
+    """
+    data_type = type(data)
+    if data_type is str or data_type is bool or data is None:
+        return True
+    if data_type is dict:
+        return all(
+            type(key) is str and same_json_with_orjson(value)
+            for key, value in data.items()
+        )
+    if data_type is list:
+        return all(same_json_with_orjson(value) for value in data)
+    if data_type is int:
+        return -(2**63) <= data < 2**63
+    return False
+
+
+def orjson_dumps_indent_4(data):
+    """Serialize data with orjson using 4 spaces indentation and sorted keys,
+    giving the same output as json.dumps
+    """
+    json_data = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    # orjson only indents with 2 spaces. Newlines inside strings are escaped,
+    # so leading spaces are only indentation. Deepest levels are done first
+    depth = 0
+    while b"\n" + b"  " * (depth + 1) in json_data:
+        depth += 1
+    for level in range(depth, 0, -1):
+        json_data = re.sub(
+            b"\n" + b" " * (2 * level) + b"(?! )",
+            b"\n" + b" " * (4 * level),
+            json_data,
+        )
+    return json_data
+
+
 def write_json_fo_file(data, file_name):
-    """Write metadata to json file"""
+    """Write metadata to json file. orjson is used when it is installed and
+    gives the same output as the json module, otherwise json module is used
+    """
+    if orjson is not None and same_json_with_orjson(data):
+        with open(file_name, "wb") as fh:
+            fh.write(orjson_dumps_indent_4(data))
+        return True
     with open(file_name, "w", encoding="utf-8") as fh:
         fh.write(json.dumps(data, indent=4, sort_keys=True, ensure_ascii=False))
     return True